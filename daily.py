@@ -1,18 +1,32 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import MetaTrader5 as mt5
-import pandas as pd
+import numpy as np
 import time
+import queue
+import threading
 import sqlite3 # Changed from pyodbc to sqlite3
 
-# Set up pandas display options
-pd.set_option('display.max_columns', 500)
-pd.set_option('display.width', 1500)
-
 # --- Configuration ---
 # SQLite database file path
 DATABASE_FILE = "BTCUSDdaily.db" # Changed to SQLite file
 TABLE_NAME = "BTCUSDdaily"  # Table name for daily data
 INITIAL_CANDLES = 5000  # Number of candles to fetch at startup
+LATEST_CANDLES = 3  # Completed candles re-fetched each wake-up, so a missed wake-up self-heals
+JOURNAL_MODE = "WAL"  # Write-ahead log: commits append to the log instead of rewriting the database
+TIME_OFFSET_SECONDS = 2 * 60 * 60  # MT5 server time is 2 hours ahead of the time we store
+WRITE_QUEUE_SIZE = 4096  # Fetched batches that may wait for the writer thread before fetches block
+WRITER_SHUTDOWN_TIMEOUT = 30  # Seconds to wait for the writer thread to drain on exit
+VERBOSE = True  # Print every wake-up and stored candle; set to False to keep the live loop quiet
+
+# Columns stored per candle, in insert order
+CANDLE_COLUMNS = ['time', 'open', 'high', 'low', 'close', 'tick_volume', 'spread', 'real_volume', 'candle_type', 'range']
+# Candle type labels indexed by sign(close - open): 0 -> neutral, 1 -> bullish, -1 -> bearish
+CANDLE_TYPES = np.array(['neutral', 'bullish', 'bearish'], dtype=object)
+# Built once at import so every insert reuses the same SQL text (and sqlite3's cached prepared statement)
+INSERT_SQL = (
+    f"INSERT OR IGNORE INTO {TABLE_NAME} ({', '.join(CANDLE_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(CANDLE_COLUMNS))})"
+)
 
 def initialize_mt5():
     """Initialize connection to MetaTrader 5 without GUI"""
@@ -26,8 +40,19 @@ def initialize_mt5():
 def create_database_connection():
     """Create a connection to SQLite database"""
     try:
-        conn = sqlite3.connect(DATABASE_FILE) # Use sqlite3.connect
+        # Autocommit mode; insert_data opens its own BEGIN/COMMIT around each batch
+        conn = sqlite3.connect(DATABASE_FILE, isolation_level=None, cached_statements=256,
+                               check_same_thread=False, # Handed over to writer_thread after startup
+                               timeout=30)
         cursor = conn.cursor()
+        # Wait up to 30 s for another process's lock (e.g. a second instance or a reader)
+        # instead of failing straight away with "database is locked"
+        cursor.execute("PRAGMA busy_timeout=30000")
+        cursor.execute(f"PRAGMA journal_mode={JOURNAL_MODE}")
+        cursor.execute("PRAGMA synchronous=NORMAL") # Skip the extra fsync FULL does on every commit
+        cursor.execute("PRAGMA cache_size=-65536") # 64 MB page cache
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456") # 256 MB memory-mapped I/O
         return conn, cursor
     except sqlite3.Error as e: # Catch sqlite3 errors
         print(f"Database connection error: {e}")
@@ -43,10 +68,12 @@ def create_table(conn, cursor, recreate=True):
             print(f"Table {TABLE_NAME} dropped (if it existed)")
 
         # Create table with added candle_type and range columns
-        # SQLite data types: TEXT for DATETIME, REAL for FLOAT, INTEGER for INT/BIGINT
+        # 'time INTEGER PRIMARY KEY' aliases the rowid: rows are clustered by time in a single
+        # B-tree, with no second index to maintain on insert (a TEXT key would need both)
+        # SQLite data types: INTEGER epoch seconds for DATETIME, REAL for FLOAT, INTEGER for INT/BIGINT
         cursor.execute(f"""
         CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
-            time TEXT PRIMARY KEY,
+            time INTEGER PRIMARY KEY, -- Epoch seconds, see TIME_OFFSET_SECONDS
             open REAL,
             high REAL,
             low REAL,
@@ -65,97 +92,112 @@ def create_table(conn, cursor, recreate=True):
         print(f"Error creating table: {e}")
         return False
 
-def determine_candle_type(open_price, close_price):
-    """Determine if a candle is bullish or bearish"""
-    if close_price > open_price:
-        return "bullish"
-    elif close_price < open_price:
-        return "bearish"
-    else:
-        return "neutral"  # When open equals close
-
-def calculate_candle_range(high, low):
-    """Calculate the range of a candle (high minus low)"""
-    return high - low
-
-def format_data(rates_frame):
-    """Process the raw MT5 data frame"""
-    if rates_frame is None or len(rates_frame) == 0:
-        return pd.DataFrame()
-
-    # Convert time in seconds to datetime format
-    rates_frame['time'] = pd.to_datetime(rates_frame['time'], unit='s')
-
-    # Remove 2 hours (timezone adjustment) - Adjust if your server/local timezone offset is different
-    rates_frame['time'] = rates_frame['time'] - pd.Timedelta(hours=2)
-    
-    # Convert datetime objects to string format for SQLite TEXT column
-    rates_frame['time_dt'] = rates_frame['time'] # Keep a datetime version for calculations if needed elsewhere
-    rates_frame['time'] = rates_frame['time'].dt.strftime('%Y-%m-%d %H:%M:%S')
-
-
-    # Calculate candle type and range
-    rates_frame['candle_type'] = rates_frame.apply(
-        lambda row: determine_candle_type(row['open'], row['close']), axis=1
-    )
-    rates_frame['range'] = rates_frame.apply(
-        lambda row: calculate_candle_range(row['high'], row['low']), axis=1
-    )
-
-    return rates_frame
-
-def insert_data(conn, cursor, data_frame):
+def format_data(rates):
+    """Turn the raw MT5 rates array into rows for the database"""
+    if rates is None or len(rates) == 0:
+        return []
+
+    # MT5 returns a numpy structured array, so work on its fields directly rather
+    # than copying everything into a DataFrame first.
+    # Keep MT5's epoch seconds as integers for the INTEGER PRIMARY KEY, shifted by
+    # TIME_OFFSET_SECONDS (timezone adjustment) - Adjust if your server/local offset is different
+    times = rates['time'].astype('int64') - TIME_OFFSET_SECONDS
+
+    # Calculate candle type (bullish/bearish, neutral when open equals close) and range on whole columns.
+    # Picking labels from an object array hands back the same str objects, instead of
+    # building a fixed-width unicode array that tolist() would decode row by row.
+    candle_types = CANDLE_TYPES[np.sign(rates['close'] - rates['open']).astype(np.intp)]
+    ranges = rates['high'] - rates['low']
+
+    # One tolist() per column is the only type conversion: it casts the whole column to
+    # plain Python ints/floats/strs in C, which sqlite3 binds directly, so no per-row
+    # float()/int() calls are needed
+    return list(zip(
+        times.tolist(),
+        rates['open'].tolist(),
+        rates['high'].tolist(),
+        rates['low'].tolist(),
+        rates['close'].tolist(),
+        rates['tick_volume'].tolist(),
+        rates['spread'].tolist(),
+        rates['real_volume'].tolist(),
+        candle_types.tolist(),
+        ranges.tolist()
+    ))
+
+def insert_data(conn, cursor, rows):
     """Insert data into the database"""
-    if data_frame is None or len(data_frame) == 0:
+    if not rows:
         print("No data to insert")
         return 0
 
-    rows_inserted = 0
-
-    for _, row in data_frame.iterrows():
-        try:
-            # Check if record already exists by primary key ('time' column)
-            cursor.execute(f"SELECT COUNT(*) FROM {TABLE_NAME} WHERE time = ?",
-                           (row['time'],))
-            if cursor.fetchone()[0] == 0: # If record does not exist
-                cursor.execute(f'''
-                INSERT INTO {TABLE_NAME}
-                (time, open, high, low, close, tick_volume, spread, real_volume, candle_type, range)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    row['time'],
-                    float(row['open']),
-                    float(row['high']),
-                    float(row['low']),
-                    float(row['close']),
-                    int(row['tick_volume']),
-                    int(row['spread']),
-                    int(row['real_volume']),
-                    row['candle_type'],
-                    float(row['range'])
-                ))
-                rows_inserted += 1
-
-                # Commit every 100 rows to avoid large transactions
-                if rows_inserted % 100 == 0:
-                    conn.commit()
-                    print(f"Committed {rows_inserted} rows so far...")
-        except sqlite3.Error as e: # Catch sqlite3 errors
-            if "UNIQUE constraint failed" in str(e):
-                # This can happen if a candle was already inserted by a previous attempt or run
-                # print(f"Skipping duplicate entry for time: {row['time']}") 
-                pass # Skip duplicate entries silently
-            else:
-                print(f"Error inserting data: {e}")
-                print(f"Problem row: {row}")
+    # executemany binds every row tuple in C; INSERT OR IGNORE skips candles
+    # already stored under the 'time' primary key.
     try:
-        conn.commit() # Final commit for any remaining rows
-        if rows_inserted > 0 :
-            print(f"Total rows inserted: {rows_inserted}")
+        # One transaction for the whole batch instead of a commit every 100 rows
+        cursor.execute("BEGIN")
+        cursor.executemany(INSERT_SQL, rows)
+        rows_inserted = cursor.rowcount
+        conn.commit()
+        # No progress output here: callers report the count once per batch
         return rows_inserted
-    except sqlite3.Error as e:
-        print(f"Error committing data: {e}")
+    except sqlite3.Error as e: # Catch sqlite3 errors
+        conn.rollback()
+        print(f"Error inserting data: {e}")
         return 0
+    except BaseException:
+        # Ctrl-C or a bad value mid-batch: leave the connection back in autocommit
+        conn.rollback()
+        raise
+
+
+def insert_historical_data(conn, cursor, rows):
+    """Bulk insert the startup history with fsync switched off"""
+    # A crash mid-load only loses candles the next run fetches again, so durability
+    # is not needed here; the live loop goes back to synchronous=NORMAL afterwards
+    cursor.execute("PRAGMA synchronous=OFF")
+    try:
+        return insert_data(conn, cursor, rows)
+    finally:
+        # PRAGMA synchronous cannot change inside a transaction; do not mask the load's own error
+        if conn.in_transaction:
+            conn.rollback()
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)") # Fold the bulk load into the main file (no-op without WAL)
+
+def format_candle(candle):
+    """Format a candle tuple for console output"""
+    candle_time, open_price, high, low, close, _, _, _, candle_type, candle_range = candle
+    candle_time = datetime.fromtimestamp(candle_time, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    return (f"time={candle_time}  open={open_price}  high={high}  low={low}  close={close}  "
+            f"candle_type={candle_type}  range={candle_range}")
+
+
+def writer_thread(conn, cursor, write_queue):
+    """Store queued (fetch time, candles) pairs until a None sentinel arrives"""
+    # Only this thread touches the connection once the main loop runs, so slow commits
+    # never push the main loop past its next fetch time
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        try:
+            fetch_attempt_time, candles = item
+            # 0 rows means INSERT OR IGNORE skipped every candle as a duplicate
+            rows = insert_data(conn, cursor, candles)
+            # Display information for monitoring
+            if VERBOSE:
+                if rows > 0:
+                    print("\n--- Data updated at:", fetch_attempt_time, "---")
+                    print("Latest stored candle (completed day):")
+                    print(format_candle(candles[-1]))
+                else:
+                    print(f"\n--- Data fetched at: {fetch_attempt_time}, but it was a duplicate or insert failed. ---")
+        except Exception as e:
+            # Log and keep going so one bad batch cannot stop the writer
+            print(f"Error in writer thread: {e}")
+            import traceback
+            traceback.print_exc()
 
 
 def fetch_initial_historical_data():
@@ -167,55 +209,49 @@ def fetch_initial_historical_data():
 
 
     if rates is not None and len(rates) > 0:
-        rates_frame = pd.DataFrame(rates)
-        rates_frame = format_data(rates_frame)
-
         # Exclude the last candle (current day's potentially unfinished)
-        # Use iloc up to the second-to-last row (all completed candles)
-        historical_data = rates_frame.iloc[:-1]
+        # Slice up to the second-to-last record (all completed candles)
+        historical_data = format_data(rates[:-1])
         print(f"Processed {len(historical_data)} historical candles (excluded last unfinished candle)")
 
         return historical_data
     else:
         print("Error: No historical data returned from MT5 for initial fetch")
-        return pd.DataFrame()
+        return []
 
 def fetch_latest_data():
-    """Fetch 2 latest daily candles, return only the completed one (yesterday's)"""
+    """Fetch the latest daily candles, return only the completed ones"""
     # Timeframe set to D1 for daily data
-    # Fetch the last 2 candles: previous day (completed) and current day (incomplete)
-    rates = mt5.copy_rates_from_pos("BTCUSD", mt5.TIMEFRAME_D1, 0, 2)
-
-    if rates is not None and len(rates) >= 2: # Ensure we got at least two candles
-        rates_frame = pd.DataFrame(rates)
-        rates_frame = format_data(rates_frame)
-
-        # copy_rates_from_pos returns data ordered oldest to newest.
-        # For count=2 from start_pos=0:
-        # rates_frame.iloc[0] is the previous completed day's candle.
-        # rates_frame.iloc[1] is the current, incomplete day's candle.
-        # We want to store the completed one.
-        latest_completed_data = rates_frame.iloc[0:1]
-        return latest_completed_data
-    
+    # Fetch the last LATEST_CANDLES completed days plus the current (incomplete) day
+    rates = mt5.copy_rates_from_pos("BTCUSD", mt5.TIMEFRAME_D1, 0, LATEST_CANDLES + 1)
+
+    if rates is not None and len(rates) >= 2: # Ensure we got at least one completed candle
+        # copy_rates_from_pos returns data ordered oldest to newest, so the last
+        # record is the current, incomplete day's candle. Store all the others;
+        # INSERT OR IGNORE drops the days that are already in the table.
+        return format_data(rates[:-1])
+
     print("Warning: Could not fetch at least 2 latest daily candles from MT5")
-    return pd.DataFrame()
+    return []
 
-def calculate_seconds_to_next_fetch():
-    """Calculate seconds until 5 seconds after the next day begins"""
+def calculate_next_fetch_time():
+    """Calculate the epoch time 5 seconds after the next day begins"""
     current_time = datetime.now()
     # Calculate the beginning of the next day
     next_day = current_time.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
     # Add 5 seconds to the beginning of the next day
     fetch_time = next_day + timedelta(seconds=5)
-    wait_seconds = (fetch_time - current_time).total_seconds()
-    
-    # Ensure wait_seconds is not negative if the current time is already past the fetch time
-    if wait_seconds < 0:
-        # If past the 5-second mark for today, target 5 seconds past the *next* actual day.
-        wait_seconds = (next_day + timedelta(days=1) + timedelta(seconds=5) - current_time).total_seconds()
-    
-    return int(wait_seconds)
+    # Return an absolute target rather than a rounded wait, so sleep_until can land on it
+    # exactly no matter how long the fetch and the prints before the sleep took.
+    # Take the naive wall-clock difference and add it to time.time(): converting the naive
+    # local fetch_time itself breaks during the repeated DST hour (timedelta resets fold).
+    return time.time() + (fetch_time - current_time).total_seconds()
+
+def sleep_until(target_time):
+    """Sleep until the wall clock reaches target_time (epoch seconds)"""
+    # time.sleep may return a little early, so re-check the clock until the target has passed
+    while (remaining := target_time - time.time()) > 0:
+        time.sleep(remaining)
 
 
 def main():
@@ -232,6 +268,7 @@ def main():
             mt5.shutdown()
         return
 
+    writer = None
     try:
         # Create table, dropping if it exists (recreate=True)
         if not create_table(conn, cursor, recreate=True): # Set recreate=True to ensure fresh table with correct schema
@@ -241,9 +278,9 @@ def main():
         # Fetch and store initial historical data
         print("Fetching initial historical data...")
         historical_data = fetch_initial_historical_data()
-        if not historical_data.empty:
-            insert_data(conn, cursor, historical_data)
-            # No need for a separate print for count, insert_data handles it if rows > 0
+        if historical_data:
+            rows = insert_historical_data(conn, cursor, historical_data)
+            print(f"Total rows inserted: {rows}")
         else:
             print("Failed to fetch initial historical data.")
             # Decide if to continue or exit if initial fetch fails
@@ -252,27 +289,24 @@ def main():
 
         # Main loop for continuous updates
         print("Starting continuous data collection...")
+        write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        writer = threading.Thread(target=writer_thread, args=(conn, cursor, write_queue), daemon=True)
+        writer.start()
         while True:
-            # Calculate seconds until the next fetch time (5 seconds after the day)
-            seconds_to_next_fetch = calculate_seconds_to_next_fetch()
+            # Calculate the next fetch time (5 seconds after the day)
+            next_fetch_time = calculate_next_fetch_time()
 
-            print(f"Waiting {seconds_to_next_fetch} seconds until next fetch (5 seconds after the next day)...")
-            time.sleep(seconds_to_next_fetch)
+            if VERBOSE:
+                print(f"Waiting {next_fetch_time - time.time():.1f} seconds until next fetch (5 seconds after the next day)...")
+            sleep_until(next_fetch_time)
 
-            # Fetch latest data (should be yesterday's completed candle)
+            # Fetch latest data (yesterday's completed candle plus a few days before it)
             fetch_attempt_time = datetime.now() # Get current time before fetching
-            latest_data = fetch_latest_data()
-
-            if not latest_data.empty:
-                # Store the completed candle to database
-                rows = insert_data(conn, cursor, latest_data)
-                if rows > 0:
-                    print("\n--- Data updated at:", fetch_attempt_time, "---")
-                    print("Latest stored candle (completed day):")
-                    print(latest_data[['time', 'open', 'high', 'low', 'close', 'candle_type', 'range']])
-                else:
-                    print(f"\n--- Data fetched at: {fetch_attempt_time}, but it was a duplicate or insert failed. ---")
+            latest_candles = fetch_latest_data()
 
+            if latest_candles:
+                # Queue the completed candles; writer_thread stores the new ones in the database
+                write_queue.put((fetch_attempt_time, latest_candles))
             else:
                 print(f"\n--- No new data available or less than 2 candles fetched at: {fetch_attempt_time} ---")
 
@@ -284,8 +318,18 @@ def main():
         import traceback
         traceback.print_exc()
     finally:
+        # Let the writer store any queued candles before closing the connection,
+        # but never hang on a full queue or a stuck writer
+        if writer is not None and writer.is_alive():
+            try:
+                write_queue.put(None, timeout=WRITER_SHUTDOWN_TIMEOUT)
+            except queue.Full:
+                print("Write queue still full, not waiting for the remaining candles")
+            writer.join(timeout=WRITER_SHUTDOWN_TIMEOUT)
+            if writer.is_alive():
+                print("Writer thread did not finish in time; queued candles may be lost")
         # Close database connection and MT5
-        if conn:
+        if conn and (writer is None or not writer.is_alive()):
             conn.close()
             print("SQLite database connection closed")
         if mt5.terminal_state()[0]: # Check if MT5 is initialized
@@ -1,18 +1,36 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 import MetaTrader5 as mt5
-import pandas as pd
+import numpy as np
+import os
 import time
+import queue
+import threading
 import sqlite3 # Changed from pyodbc to sqlite3
 
-# Set up pandas display options
-pd.set_option('display.max_columns', 500)
-pd.set_option('display.width', 1500)
-
 # --- Configuration ---
-# SQLite database file path on the Z: drive (for shared folders)
-DATABASE_FILE = r"Z:\Users\swift\Desktop\BTCUSDminutes.db" # Changed to SQLite file on Z: drive
+# SQLite database file path on local disk; SQLite over the Z: SMB share turns every lock and fsync into a network round-trip
+DATABASE_FILE = "BTCUSDminutes.db"
+# Snapshot copied to the Z: drive (for shared folders) by replicate_to_network
+NETWORK_DATABASE_FILE = r"Z:\Users\swift\Desktop\BTCUSDminutes.db"
+REPLICATION_INTERVAL = 60 * 60  # Seconds between snapshots to NETWORK_DATABASE_FILE
 TABLE_NAME = "BTCUSDminutes"  # Table name for minute data
 INITIAL_CANDLES = 90000  # Number of candles to fetch at startup (approx 62.5 days of M1 data)
+LATEST_CANDLES = 5  # Completed candles re-fetched each wake-up, so a missed wake-up self-heals
+JOURNAL_MODE = "WAL"  # Write-ahead log: commits append to the log instead of rewriting the database
+TIME_OFFSET_SECONDS = 2 * 60 * 60  # MT5 server time is 2 hours ahead of the time we store
+WRITE_QUEUE_SIZE = 4096  # Fetched batches that may wait for the writer thread before fetches block
+WRITER_SHUTDOWN_TIMEOUT = 30  # Seconds to wait for the writer (and replication) thread on exit
+VERBOSE = True  # Print every wake-up and stored candle; set to False to keep the live loop quiet
+
+# Columns stored per candle, in insert order
+CANDLE_COLUMNS = ['time', 'open', 'high', 'low', 'close', 'tick_volume', 'spread', 'real_volume', 'candle_type', 'range']
+# Candle type labels indexed by sign(close - open): 0 -> neutral, 1 -> bullish, -1 -> bearish
+CANDLE_TYPES = np.array(['neutral', 'bullish', 'bearish'], dtype=object)
+# Built once at import so every insert reuses the same SQL text (and sqlite3's cached prepared statement)
+INSERT_SQL = (
+    f"INSERT OR IGNORE INTO {TABLE_NAME} ({', '.join(CANDLE_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(CANDLE_COLUMNS))})"
+)
 
 def initialize_mt5():
     """Initialize connection to MetaTrader 5 without GUI"""
@@ -25,8 +43,19 @@ def initialize_mt5():
 def create_database_connection():
     """Create a connection to SQLite database"""
     try:
-        conn = sqlite3.connect(DATABASE_FILE) # Use sqlite3.connect
+        # Autocommit mode; insert_data opens its own BEGIN/COMMIT around each batch
+        conn = sqlite3.connect(DATABASE_FILE, isolation_level=None, cached_statements=256,
+                               check_same_thread=False, # Handed over to writer_thread after startup
+                               timeout=30)
         cursor = conn.cursor()
+        # Wait up to 30 s for another process's lock (e.g. a second instance or a reader)
+        # instead of failing straight away with "database is locked"
+        cursor.execute("PRAGMA busy_timeout=30000")
+        cursor.execute(f"PRAGMA journal_mode={JOURNAL_MODE}")
+        cursor.execute("PRAGMA synchronous=NORMAL") # Skip the extra fsync FULL does on every commit
+        cursor.execute("PRAGMA cache_size=-65536") # 64 MB page cache
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456") # 256 MB memory-mapped I/O
         return conn, cursor
     except sqlite3.Error as e: # Catch sqlite3 errors
         print(f"Database connection error: {e}")
@@ -42,10 +71,12 @@ def create_table(conn, cursor, recreate=True):
             print(f"Table {TABLE_NAME} dropped (if it existed)")
 
         # Create table with added candle_type and range columns
+        # 'time INTEGER PRIMARY KEY' aliases the rowid: rows are clustered by time in a single
+        # B-tree, with no second index to maintain on insert (a TEXT key would need both)
         # Column names don't need escaping in SQLite unless they are keywords
         cursor.execute(f"""
         CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
-            time TEXT PRIMARY KEY, -- SQLite uses TEXT for DATETIME
+            time INTEGER PRIMARY KEY, -- Epoch seconds, see TIME_OFFSET_SECONDS
             open REAL,
             high REAL,
             low REAL,
@@ -64,100 +95,145 @@ def create_table(conn, cursor, recreate=True):
         print(f"Error creating table: {e}")
         return False
 
-def determine_candle_type(open_price, close_price):
-    """Determine if a candle is bullish or bearish"""
-    if close_price > open_price:
-        return "bullish"
-    elif close_price < open_price:
-        return "bearish"
-    else:
-        return "neutral"  # When open equals close
-
-def calculate_candle_range(high, low):
-    """Calculate the range of a candle (high minus low)"""
-    return high - low
-
-def format_data(rates_frame):
-    """Process the raw MT5 data frame"""
-    if rates_frame is None or len(rates_frame) == 0:
-        return pd.DataFrame()
-
-    # Convert time in seconds to datetime format
-    rates_frame['time'] = pd.to_datetime(rates_frame['time'], unit='s')
-
-    # Remove 2 hours (timezone adjustment) - This assumes your MT5 server time
-    # is 2 hours ahead of the local time you want to store.
-    # Adjust this if your local/desired timezone offset is different.
-    rates_frame['time'] = rates_frame['time'] - pd.Timedelta(hours=2)
-
-    # Convert datetime objects to string format for SQLite TEXT column
-    rates_frame['time'] = rates_frame['time'].dt.strftime('%Y-%m-%d %H:%M:%S') # Format for SQLite TEXT
-
-    # Calculate candle type and range
-    rates_frame['candle_type'] = rates_frame.apply(
-        lambda row: determine_candle_type(row['open'], row['close']), axis=1
-    )
-    rates_frame['range'] = rates_frame.apply(
-        lambda row: calculate_candle_range(row['high'], row['low']), axis=1
-    )
-
-    return rates_frame
-
-def insert_data(conn, cursor, data_frame):
+def format_data(rates):
+    """Turn the raw MT5 rates array into rows for the database"""
+    if rates is None or len(rates) == 0:
+        return []
+
+    # MT5 returns a numpy structured array, so work on its fields directly rather
+    # than copying everything into a DataFrame first.
+    # Keep MT5's epoch seconds as integers for the INTEGER PRIMARY KEY, shifted by
+    # TIME_OFFSET_SECONDS (timezone adjustment) - Adjust if your server/local offset is different
+    times = rates['time'].astype('int64') - TIME_OFFSET_SECONDS
+
+    # Calculate candle type (bullish/bearish, neutral when open equals close) and range on whole columns.
+    # Picking labels from an object array hands back the same str objects, instead of
+    # building a fixed-width unicode array that tolist() would decode row by row.
+    candle_types = CANDLE_TYPES[np.sign(rates['close'] - rates['open']).astype(np.intp)]
+    ranges = rates['high'] - rates['low']
+
+    # One tolist() per column is the only type conversion: it casts the whole column to
+    # plain Python ints/floats/strs in C, which sqlite3 binds directly, so no per-row
+    # float()/int() calls are needed
+    return list(zip(
+        times.tolist(),
+        rates['open'].tolist(),
+        rates['high'].tolist(),
+        rates['low'].tolist(),
+        rates['close'].tolist(),
+        rates['tick_volume'].tolist(),
+        rates['spread'].tolist(),
+        rates['real_volume'].tolist(),
+        candle_types.tolist(),
+        ranges.tolist()
+    ))
+
+def insert_data(conn, cursor, rows):
     """Insert data into the database"""
-    if data_frame is None or len(data_frame) == 0:
+    if not rows:
         print("No data to insert")
         return 0
 
-    rows_inserted = 0
-
-    for _, row in data_frame.iterrows():
-        try:
-            # Check if record already exists by primary key ('time' column)
-            # SQLite does not use dbo. prefix, and column names don't need escaping in the query itself.
-            cursor.execute(f"SELECT COUNT(*) FROM {TABLE_NAME} WHERE time = ?",
-                           (row['time'],))
-            if cursor.fetchone()[0] == 0: # If record does not exist
-                cursor.execute(f'''
-                INSERT INTO {TABLE_NAME}
-                (time, open, high, low, close, tick_volume, spread, real_volume, candle_type, range)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    row['time'],
-                    float(row['open']),
-                    float(row['high']),
-                    float(row['low']),
-                    float(row['close']),
-                    int(row['tick_volume']),
-                    int(row['spread']),
-                    int(row['real_volume']),
-                    row['candle_type'],
-                    float(row['range'])
-                ))
-                rows_inserted += 1
-
-                # Commit every 100 rows to avoid large transactions
-                if rows_inserted % 100 == 0:
-                    conn.commit()
-                    print(f"Committed {rows_inserted} rows so far...")
-        except sqlite3.Error as e: # Catch sqlite3 errors
-            # Handle cases where a record might be inserted by another process or committed
-            # right after check. SQLite's IntegrityError for PRIMARY KEY is common.
-            if "UNIQUE constraint failed" in str(e):
-                # print(f"Skipping duplicate entry for time: {row['time']}")
-                pass # This is expected for existing candles, so we just skip it
-            else:
-                print(f"Error inserting data: {e}")
-                print(f"Problem row: {row}")
-
+    # executemany binds every row tuple in C; INSERT OR IGNORE skips candles
+    # already stored under the 'time' primary key.
     try:
-        # Final commit for remaining rows
+        # One transaction for the whole batch instead of a commit every 100 rows
+        cursor.execute("BEGIN")
+        cursor.executemany(INSERT_SQL, rows)
+        rows_inserted = cursor.rowcount
         conn.commit()
-        print(f"Total rows inserted: {rows_inserted}")
+        # No progress output here: callers report the count once per batch
         return rows_inserted
     except sqlite3.Error as e: # Catch sqlite3 errors
-        print(f"Error committing data: {e}")
+        conn.rollback()
+        print(f"Error inserting data: {e}")
         return 0
+    except BaseException:
+        # Ctrl-C or a bad value mid-batch: leave the connection back in autocommit
+        conn.rollback()
+        raise
+
+
+def insert_historical_data(conn, cursor, rows):
+    """Bulk insert the startup history with fsync switched off"""
+    # A crash mid-load only loses candles the next run fetches again, so durability
+    # is not needed here; the live loop goes back to synchronous=NORMAL afterwards
+    cursor.execute("PRAGMA synchronous=OFF")
+    try:
+        return insert_data(conn, cursor, rows)
+    finally:
+        # PRAGMA synchronous cannot change inside a transaction; do not mask the load's own error
+        if conn.in_transaction:
+            conn.rollback()
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)") # Fold the bulk load into the main file (no-op without WAL)
+
+def format_candle(candle):
+    """Format a candle tuple for console output"""
+    candle_time, open_price, high, low, close, _, _, _, candle_type, candle_range = candle
+    candle_time = datetime.fromtimestamp(candle_time, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    return (f"time={candle_time}  open={open_price}  high={high}  low={low}  close={close}  "
+            f"candle_type={candle_type}  range={candle_range}")
+
+
+def writer_thread(conn, cursor, write_queue):
+    """Store queued (fetch time, candles) pairs until a None sentinel arrives"""
+    # Only this thread touches the connection once the main loop runs, so slow commits
+    # never push the main loop past its next fetch time
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        try:
+            current_time, candles = item
+            # 0 rows means INSERT OR IGNORE skipped every candle as a duplicate
+            rows = insert_data(conn, cursor, candles)
+            # Display information for monitoring
+            if VERBOSE:
+                if rows > 0:
+                    print("\n--- Data updated at:", current_time, "---")
+                    print("Latest stored candle (completed minute):")
+                    print(format_candle(candles[-1]))
+                else:
+                    print(f"\n--- Data fetched at: {current_time}, but it was a duplicate or insert failed. ---")
+        except Exception as e:
+            # Log and keep going so one bad batch cannot stop the writer
+            print(f"Error in writer thread: {e}")
+            import traceback
+            traceback.print_exc()
+
+
+def replicate_to_network():
+    """Copy a consistent snapshot of the local database to the Z: drive"""
+    temp_file = NETWORK_DATABASE_FILE + ".tmp"
+    try:
+        if os.path.exists(temp_file):
+            os.remove(temp_file) # VACUUM INTO refuses to overwrite an existing file
+        # A separate read connection; under WAL it does not block the writer thread
+        snapshot_conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+        try:
+            snapshot_conn.cursor().execute("VACUUM INTO ?", (temp_file,))
+        finally:
+            snapshot_conn.close()
+        # Swap the finished snapshot in so readers on the share never see a partial file
+        os.replace(temp_file, NETWORK_DATABASE_FILE)
+        print(f"Database snapshot copied to {NETWORK_DATABASE_FILE}")
+        return True
+    except (sqlite3.Error, OSError) as e:
+        print(f"Error copying database snapshot to network: {e}")
+        return False
+
+
+def replication_thread(stop_event):
+    """Snapshot the database to the Z: drive every REPLICATION_INTERVAL until stop_event is set"""
+    # Runs on its own thread (and replicate_to_network uses its own connection), so the
+    # network copy never delays the fetch loop or the writer thread
+    while not stop_event.is_set():
+        try:
+            replicate_to_network()
+        except Exception as e:
+            print(f"Error in replication thread: {e}")
+        stop_event.wait(REPLICATION_INTERVAL)
 
 
 def fetch_initial_historical_data():
@@ -167,56 +243,49 @@ def fetch_initial_historical_data():
     rates = mt5.copy_rates_from_pos("BTCUSD", mt5.TIMEFRAME_M1, 0, INITIAL_CANDLES)
 
     if rates is not None and len(rates) > 0:
-        rates_frame = pd.DataFrame(rates)
-        rates_frame = format_data(rates_frame)
-
         # Exclude the last candle (potentially unfinished, current minute)
-        historical_data = rates_frame.iloc[:-1]
+        historical_data = format_data(rates[:-1])
         print(f"Processed {len(historical_data)} historical candles (excluded last unfinished candle)")
 
         return historical_data
     else:
         print("Error: No historical data returned from MT5")
-        return pd.DataFrame()
+        return []
 
 def fetch_latest_data():
-    """Fetch 2 latest candles, return only the completed one (previous minute)"""
+    """Fetch the latest candles, return only the completed ones (previous minutes)"""
     # Timeframe set to M1 for minute data
-    # We fetch 2 candles: the current (incomplete) minute and the previous (completed) minute.
-    rates = mt5.copy_rates_from_pos("BTCUSD", mt5.TIMEFRAME_M1, 0, 2)
-
-    if rates is not None and len(rates) >= 2: # Ensure we got at least two candles
-        rates_frame = pd.DataFrame(rates)
-        rates_frame = format_data(rates_frame)
+    # We fetch LATEST_CANDLES completed minutes plus the current (incomplete) minute.
+    rates = mt5.copy_rates_from_pos("BTCUSD", mt5.TIMEFRAME_M1, 0, LATEST_CANDLES + 1)
 
+    if rates is not None and len(rates) >= 2: # Ensure we got at least one completed candle
         # The latest data returned by copy_rates_from_pos(..., 0, count) is ordered
-        # from oldest to newest. So, if count=2, index 0 is the previous minute's
-        # completed candle, and index 1 is the current (incomplete) minute's candle.
-        # We want to store the completed one, which is at index 0.
-        latest_completed_candle = rates_frame.iloc[0:1]
-        return latest_completed_candle, rates_frame
+        # from oldest to newest, so the last record is the current (incomplete)
+        # minute's candle. We store all the completed ones before it; INSERT OR IGNORE
+        # drops the minutes that are already in the table.
+        return format_data(rates[:-1])
 
     print("Warning: Could not fetch at least 2 latest minute candles from MT5.")
-    return pd.DataFrame(), pd.DataFrame()
-
-def calculate_seconds_to_next_fetch():
-    """Calculate seconds until 5 seconds after the next minute begins"""
-    current_time = datetime.now()
-    # Calculate the beginning of the next minute
-    next_minute = current_time.replace(second=0, microsecond=0) + timedelta(minutes=1)
-    # Add 5 seconds to the beginning of the next minute
-    fetch_time = next_minute + timedelta(seconds=5)
-    wait_seconds = (fetch_time - current_time).total_seconds()
-    # Ensure wait_seconds is not negative if the current time is already past the fetch time.
-    # If it's already past the 5-second mark of the current minute, wait for the next minute.
-    if wait_seconds < 0:
-        wait_seconds = (next_minute + timedelta(minutes=1) + timedelta(seconds=5) - current_time).total_seconds()
-    
-    return int(wait_seconds)
+    return []
+
+def calculate_next_fetch_time():
+    """Calculate the epoch time 5 seconds after the next minute begins"""
+    # Work in epoch seconds rather than naive local datetimes: around a DST change the
+    # local clock repeats or skips an hour, and a converted local time can land in the past.
+    # Minute boundaries are the same in every timezone.
+    current_time = time.time()
+    # Beginning of the next minute, plus 5 seconds
+    return (current_time // 60 + 1) * 60 + 5
+
+def sleep_until(target_time):
+    """Sleep until the wall clock reaches target_time (epoch seconds)"""
+    # time.sleep may return a little early, so re-check the clock until the target has passed
+    while (remaining := target_time - time.time()) > 0:
+        time.sleep(remaining)
 
 
 def main():
-    print("Starting MetaTrader5 BTC minute data collection with enhanced candle analysis (SQLite3 on Z:)...")
+    print("Starting MetaTrader5 BTC minute data collection with enhanced candle analysis (SQLite3, replicated to Z:)...")
     # Initialize MT5
     if not initialize_mt5():
         return
@@ -228,6 +297,8 @@ def main():
         mt5.shutdown()
         return
 
+    writer = None
+    replicator = None
     try:
         # Create table, dropping if it exists
         if not create_table(conn, cursor, recreate=True):
@@ -237,9 +308,9 @@ def main():
         # Fetch and store initial historical data
         print("Fetching initial historical data...")
         historical_data = fetch_initial_historical_data()
-        if not historical_data.empty:
-            insert_data(conn, cursor, historical_data)
-            print(f"Added {len(historical_data)} initial candles to database")
+        if historical_data:
+            rows = insert_historical_data(conn, cursor, historical_data)
+            print(f"Added {rows} initial candles to database")
         else:
             print("Failed to fetch initial historical data.")
             print("Proceeding with real-time data collection anyway...")
@@ -247,25 +318,28 @@ def main():
 
         # Main loop for continuous updates
         print("Starting continuous data collection...")
+        write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        writer = threading.Thread(target=writer_thread, args=(conn, cursor, write_queue), daemon=True)
+        writer.start()
+        # Snapshot to Z: right away, then every REPLICATION_INTERVAL
+        stop_replication = threading.Event()
+        replicator = threading.Thread(target=replication_thread, args=(stop_replication,), daemon=True)
+        replicator.start()
         while True:
-            # Calculate seconds until the next fetch time (5 seconds after the minute)
-            seconds_to_next_fetch = calculate_seconds_to_next_fetch()
+            # Calculate the next fetch time (5 seconds after the minute)
+            next_fetch_time = calculate_next_fetch_time()
 
-            print(f"Waiting {seconds_to_next_fetch} seconds until next fetch (5 seconds after the minute)...")
-            time.sleep(seconds_to_next_fetch)
+            if VERBOSE:
+                print(f"Waiting {next_fetch_time - time.time():.1f} seconds until next fetch (5 seconds after the minute)...")
+            sleep_until(next_fetch_time)
 
-            # Fetch latest data (we expect 2 candles, store the completed one)
+            # Fetch latest data (the last few completed candles, in case a wake-up was missed)
             current_time = datetime.now() # Get current time before fetching
-            latest_data, full_data = fetch_latest_data()
-
-            if not latest_data.empty:
-                # Store the completed candle to database
-                insert_data(conn, cursor, latest_data)
+            latest_candles = fetch_latest_data()
 
-                # Display information for monitoring
-                print("\n--- Data updated at:", current_time, "---")
-                print("Latest stored candle (completed minute):")
-                print(latest_data[['time', 'open', 'high', 'low', 'close', 'candle_type', 'range']])
+            if latest_candles:
+                # Queue the completed candles; writer_thread stores the new ones in the database
+                write_queue.put((current_time, latest_candles))
             else:
                 print(f"\n--- No new data available (or less than 2 candles fetched) at: {current_time} ---")
 
@@ -277,8 +351,25 @@ def main():
         import traceback
         traceback.print_exc()
     finally:
+        # Let the writer store any queued candles before closing the connection,
+        # but never hang on a full queue or a stuck writer
+        if writer is not None and writer.is_alive():
+            try:
+                write_queue.put(None, timeout=WRITER_SHUTDOWN_TIMEOUT)
+            except queue.Full:
+                print("Write queue still full, not waiting for the remaining candles")
+            writer.join(timeout=WRITER_SHUTDOWN_TIMEOUT)
+            if writer.is_alive():
+                print("Writer thread did not finish in time; queued candles may be lost")
+        # Stop the hourly snapshots and publish a final one with everything stored,
+        # so the share is not left up to an hour stale
+        if replicator is not None:
+            stop_replication.set()
+            replicator.join(timeout=WRITER_SHUTDOWN_TIMEOUT)
+            if not replicator.is_alive():
+                replicate_to_network()
         # Close database connection and MT5
-        if conn:
+        if conn and (writer is None or not writer.is_alive()):
             conn.close()
         mt5.shutdown()
         print("MT5 connection closed and database connection closed")